@@ -1,5 +1,12 @@
 ## kullerbue-marble-storage
+import functools
+import math
+from dataclasses import dataclass
+
 import cadquery as cq
+from OCP.BRepBuilderAPI import BRepBuilderAPI_RightCorner
+from OCP.BRepOffsetAPI import BRepOffsetAPI_MakePipeShell
+from OCP.Standard import Standard_Failure
 
 # =============================================================================
 # PARAMETERS
@@ -19,6 +26,9 @@ turn_factor = 1.3           # turn_radius = tube_radius * turn_factor
 # Outlet
 outlet_factor = 1.3         # outlet_length = tube_radius * outlet_factor
 
+# Groove sweep
+sweep_tolerance = 1e-3      # mm (OCCT default 1e-4 is far finer than printable)
+
 # Housing
 wall_thickness = 5          # mm
 enable_fillet = True        # round edges
@@ -29,6 +39,10 @@ enable_windows = True
 window_height_factor = 0.8  # Höhe = tube_radius * factor
 window_margin_factor = 0.5  # Abstand vom Rand = tube_radius * factor
 
+# Export
+stl_tolerance = 0.2         # mm linear deflection (finer is invisible in print)
+stl_angular_tolerance = 0.3 # rad
+
 # =============================================================================
 # DERIVED VALUES
 # =============================================================================
@@ -38,11 +52,195 @@ turn_radius = tube_radius * turn_factor
 outlet_length = tube_radius * outlet_factor
 
 # =============================================================================
-# PATH GENERATION
+# CACHING
 # =============================================================================
 
-def make_marble_path():
-    """Generate the serpentine path for the marble tunnel."""
+def memoize(*parameter_names):
+    """Cache a builder on its arguments plus the module parameters it reads.
+    
+    Geometry inputs travel in the Layout argument; only parameters read from
+    module scope are listed, so changing e.g. the housing leaves path, groove
+    and window caches valid.
+    """
+    
+    def decorator(func):
+        @functools.lru_cache(maxsize=8)
+        def cached(parameters, *args):
+            return func(*args)
+        
+        @functools.wraps(func)
+        def wrapper(*args):
+            return cached(tuple(globals()[name] for name in parameter_names), *args)
+        
+        return wrapper
+    
+    return decorator
+
+# =============================================================================
+# BOOLEAN HELPERS
+# =============================================================================
+
+def cascade_union(shapes):
+    """Fuse shapes pairwise in a balanced tree: [a,b,c,d,e] -> [ab,cd,e] -> [abcd,e] -> abcde."""
+    
+    shapes = [s.val() if isinstance(s, cq.Workplane) else s for s in shapes]
+    
+    while len(shapes) > 1:
+        fused = [a.fuse(b) for a, b in zip(shapes[::2], shapes[1::2])]
+        if len(shapes) % 2:
+            fused.append(shapes[-1])
+        shapes = fused
+    
+    return cq.Workplane("XY").add(shapes[0])
+
+# =============================================================================
+# EDGE HELPERS
+# =============================================================================
+
+def classify_edges(solid):
+    """Sort the straight edges of a solid by axis ("X", "Y", "Z") in one topology walk."""
+    
+    axes = {"X": cq.Vector(1, 0, 0), "Y": cq.Vector(0, 1, 0), "Z": cq.Vector(0, 0, 1)}
+    edges = {name: [] for name in axes}
+    
+    for edge in solid.Edges():
+        if edge.geomType() != "LINE":
+            continue
+        direction = edge.tangentAt(0)
+        for name, axis in axes.items():
+            if abs(direction.dot(axis)) > 1 - 1e-6:
+                edges[name].append(edge)
+                break
+    
+    return edges
+
+
+def top_edges(edges):
+    """Edges at the highest Z position (same as the ">Z" selector)."""
+    
+    z_max = max(e.Center().z for e in edges)
+    return [e for e in edges if abs(e.Center().z - z_max) < 1e-4]
+
+
+def fillet_edges(workplane, edges, radius):
+    """Fillet the given edges; edges too short for the radius are skipped up front."""
+    
+    edges = [e for e in edges if e.Length() > 2 * radius]
+    if not edges:
+        return workplane
+    
+    try:
+        return workplane.newObject(edges).fillet(radius)
+    except (Standard_Failure, ValueError):
+        return workplane
+
+# =============================================================================
+# LAYOUT
+# =============================================================================
+
+@dataclass(frozen=True)
+class Layout:
+    """Radii, section lengths, height gains and key points of the marble path (YZ plane)."""
+    
+    tube_radius: float
+    turn_radius: float
+    slope: float
+    start_cap_z: float   # centre of the start sphere (below the outlet)
+    
+    layer1_len: float
+    layer2_len: float
+    layer3_len: float
+    
+    layer1_height: float
+    layer2_height: float
+    layer3_height: float
+    
+    outlet_start_y: float
+    outlet_start_z: float
+    outlet_end_y: float
+    outlet_end_z: float
+    
+    layer1_start_y: float
+    layer1_start_z: float
+    layer1_end_y: float
+    layer1_end_z: float
+    
+    turn1_apex_y: float
+    turn1_apex_z: float
+    
+    layer2_start_y: float
+    layer2_start_z: float
+    layer2_end_y: float
+    layer2_end_z: float
+    
+    turn2_apex_y: float
+    turn2_apex_z: float
+    
+    layer3_start_y: float
+    layer3_start_z: float
+    layer3_end_y: float
+    layer3_end_z: float
+    
+    @property
+    def end_point(self):
+        """End of the path, known analytically - no wire traversal needed."""
+        return cq.Vector(0, self.layer3_end_y, self.layer3_end_z)
+
+
+@dataclass(frozen=True)
+class GrooveBounds:
+    """Axis-aligned extents of the groove solid (same fields as cq.BoundBox)."""
+    
+    xmin: float
+    xmax: float
+    ymin: float
+    ymax: float
+    zmin: float
+    zmax: float
+    
+    @property
+    def xlen(self):
+        return self.xmax - self.xmin
+    
+    @property
+    def ylen(self):
+        return self.ymax - self.ymin
+    
+    @property
+    def zlen(self):
+        return self.zmax - self.zmin
+
+
+def groove_bounds(layout):
+    """Extents of tube + end spheres from the path layout - no OCCT bounding box walk."""
+    
+    lo = layout
+    r = lo.tube_radius
+    
+    # Tube and spheres reach tube_radius beyond the path in every direction.
+    # Extreme path points: in Y the turn apexes (mid-height of the turns); in Z
+    # the ends of the straight layers - lowest is outlet or end of layer 1 (start
+    # sphere below), highest is start or end of layer 3 (i.e. the top of turn 2)
+    return GrooveBounds(
+        xmin=-r,
+        xmax=r,
+        ymin=min(lo.outlet_start_y, lo.turn2_apex_y) - r,
+        ymax=max(lo.turn1_apex_y, lo.layer3_end_y) + r,
+        zmin=min(lo.outlet_start_z, lo.layer1_end_z, lo.start_cap_z) - r,
+        zmax=max(lo.layer3_start_z, lo.layer3_end_z) + r,
+    )
+
+
+def compute_layout(tube_radius, turn_radius, outlet_length, marbles_per_layer, slope):
+    """Compute all path dimensions once; shared by path, windows and housing.
+    
+    Pure function of its arguments (no globals). Radii and slope are carried in
+    the layout and the builders read them from there, so parameter sweeps can
+    build their own layout with this function and pass it on.
+    """
+    
+    # Start sphere sits below the outlet
+    start_cap_z = -0.35 * tube_radius
     
     # Section lengths
     layer1_len = marbles_per_layer * tube_radius * 2
@@ -66,8 +264,13 @@ def make_marble_path():
     layer1_end_y = outlet_end_y + layer1_len
     layer1_end_z = layer1_height
     
+    # Turns: exact circles tangent to both adjacent layers. The chord is vertical
+    # (length 2 * turn_radius), so the radius is turn_radius * sqrt(1 + slope²);
+    # the apex is the point furthest out in Y, at mid-height of the turn
+    turn_bulge = turn_radius * (math.sqrt(1 + slope ** 2) - slope)
+    
     # Turn 1
-    turn1_apex_y = layer1_end_y + turn_radius
+    turn1_apex_y = layer1_end_y + turn_bulge
     turn1_apex_z = layer1_end_z + turn_radius
     
     # Layer 2 (direction: -Y)
@@ -77,7 +280,7 @@ def make_marble_path():
     layer2_end_z = layer2_start_z + layer2_height
     
     # Turn 2
-    turn2_apex_y = layer2_end_y - turn_radius
+    turn2_apex_y = layer2_end_y - turn_bulge
     turn2_apex_z = layer2_end_z + turn_radius
     
     # Layer 3 (direction: +Y)
@@ -86,29 +289,56 @@ def make_marble_path():
     layer3_end_y = layer3_start_y + layer3_len
     layer3_end_z = layer3_start_z + layer3_height
     
-    # Arcs with tangents
-    turn1 = cq.Edge.makeSpline(
-        [cq.Vector(0, layer1_end_y, layer1_end_z),
-         cq.Vector(0, turn1_apex_y, turn1_apex_z),
-         cq.Vector(0, layer2_start_y, layer2_start_z)],
-        tangents=[cq.Vector(0, 1, slope), cq.Vector(0, 0, 1), cq.Vector(0, -1, slope)]
+    return Layout(
+        tube_radius=tube_radius, turn_radius=turn_radius, slope=slope, start_cap_z=start_cap_z,
+        layer1_len=layer1_len, layer2_len=layer2_len, layer3_len=layer3_len,
+        layer1_height=layer1_height, layer2_height=layer2_height, layer3_height=layer3_height,
+        outlet_start_y=outlet_start_y, outlet_start_z=outlet_start_z,
+        outlet_end_y=outlet_end_y, outlet_end_z=outlet_end_z,
+        layer1_start_y=layer1_start_y, layer1_start_z=layer1_start_z,
+        layer1_end_y=layer1_end_y, layer1_end_z=layer1_end_z,
+        turn1_apex_y=turn1_apex_y, turn1_apex_z=turn1_apex_z,
+        layer2_start_y=layer2_start_y, layer2_start_z=layer2_start_z,
+        layer2_end_y=layer2_end_y, layer2_end_z=layer2_end_z,
+        turn2_apex_y=turn2_apex_y, turn2_apex_z=turn2_apex_z,
+        layer3_start_y=layer3_start_y, layer3_start_z=layer3_start_z,
+        layer3_end_y=layer3_end_y, layer3_end_z=layer3_end_z,
     )
+
+# =============================================================================
+# PATH GENERATION
+# =============================================================================
+
+@memoize()
+def make_marble_path(layout):
+    """Generate the serpentine path for the marble tunnel."""
     
-    turn2 = cq.Edge.makeSpline(
-        [cq.Vector(0, layer2_end_y, layer2_end_z),
-         cq.Vector(0, turn2_apex_y, turn2_apex_z),
-         cq.Vector(0, layer3_start_y, layer3_start_z)],
-        tangents=[cq.Vector(0, -1, slope), cq.Vector(0, 0, 1), cq.Vector(0, 1, slope)]
-    )
+    lo = layout
+    
+    # Path points in order, each converted to a Vector exactly once -
+    # junctions are shared by the adjacent edges
+    (outlet_start, layer1_start, layer1_end, layer2_start,
+     layer2_end, layer3_start, layer3_end) = [
+        cq.Vector(0, y, z) for y, z in (
+            (lo.outlet_start_y, lo.outlet_start_z),
+            (lo.layer1_start_y, lo.layer1_start_z),  # = outlet end
+            (lo.layer1_end_y, lo.layer1_end_z),
+            (lo.layer2_start_y, lo.layer2_start_z),
+            (lo.layer2_end_y, lo.layer2_end_z),
+            (lo.layer3_start_y, lo.layer3_start_z),
+            (lo.layer3_end_y, lo.layer3_end_z),
+        )
+    ]
     
-    # Assemble edges
+    # Turns are exact circle arcs tangent to the incoming layer; with a vertical
+    # chord they are tangent to the outgoing layer as well (G1 wire)
     edges = [
-        cq.Edge.makeLine((0, outlet_start_y, outlet_start_z), (0, outlet_end_y, outlet_end_z)),
-        cq.Edge.makeLine((0, layer1_start_y, layer1_start_z), (0, layer1_end_y, layer1_end_z)),
-        turn1,
-        cq.Edge.makeLine((0, layer2_start_y, layer2_start_z), (0, layer2_end_y, layer2_end_z)),
-        turn2,
-        cq.Edge.makeLine((0, layer3_start_y, layer3_start_z), (0, layer3_end_y, layer3_end_z)),
+        cq.Edge.makeLine(outlet_start, layer1_start),
+        cq.Edge.makeLine(layer1_start, layer1_end),
+        cq.Edge.makeTangentArc(layer1_end, cq.Vector(0, 1, lo.slope), layer2_start),
+        cq.Edge.makeLine(layer2_start, layer2_end),
+        cq.Edge.makeTangentArc(layer2_end, cq.Vector(0, -1, lo.slope), layer3_start),
+        cq.Edge.makeLine(layer3_start, layer3_end),
     ]
     
     return cq.Wire.assembleEdges(edges)
@@ -117,39 +347,54 @@ def make_marble_path():
 # GROOVE SOLID
 # =============================================================================
 
-def make_groove_solid(path):
+@memoize("sweep_tolerance")
+def make_groove_solid(path, layout):
     """Create the tube solid by sweeping a circle along the path."""
     
-    profile = cq.Workplane("XZ").circle(tube_radius)
-    tube = profile.sweep(path, isFrenet=True, transition="round")
-    tube = tube.clean()
-    
-    sphere_start = cq.Workplane("XY").sphere(tube_radius).translate((0, 0, -.35 * tube_radius))
-    sphere_end = cq.Workplane("XY").sphere(tube_radius).translate(path.endPoint().toTuple())
-    
-    return tube.union(sphere_start).union(sphere_end)
+    tube_radius = layout.tube_radius
+    
+    # Circle profile in the XZ plane (normal as for Workplane("XZ"))
+    profile = cq.Wire.makeCircle(tube_radius, cq.Vector(0, 0, 0), cq.Vector(0, -1, 0))
+    
+    # Pipe shell built directly to set a mm-scale tolerance.
+    # Path is tangent-continuous apart from the small outlet/layer 1 slope kink - "right" is enough,
+    # no clean(): the tube is only a cutting tool, the final cut cleans anyway
+    builder = BRepOffsetAPI_MakePipeShell(path.wrapped)
+    builder.SetMode(True)  # Frenet
+    builder.SetTolerance(sweep_tolerance, sweep_tolerance, 1e-2)
+    builder.SetTransitionMode(BRepBuilderAPI_RightCorner)
+    builder.Add(profile.wrapped)
+    builder.Build()
+    if not builder.IsDone():
+        raise ValueError("Groove sweep failed")
+    if not builder.MakeSolid():
+        raise ValueError("Groove sweep did not produce a closed solid")
+    tube = cq.Shape.cast(builder.Shape())
+    
+    # Full spheres (makeSphere defaults to a hemisphere: angleDegrees1=0)
+    sphere_start = cq.Solid.makeSphere(tube_radius, cq.Vector(0, 0, layout.start_cap_z), angleDegrees1=-90)
+    sphere_end = cq.Solid.makeSphere(tube_radius, layout.end_point, angleDegrees1=-90)
+    
+    # Both spheres as tools of one fuse
+    return cq.Workplane("XY").add(tube.fuse(sphere_start, sphere_end))
 
 # =============================================================================
 # WINDOWS
 # =============================================================================
 
-def make_windows():
-    """Create window cutouts on the long sides of the box."""
-    
-    layer1_len = marbles_per_layer * tube_radius * 2
-    layer2_len = (marbles_per_layer - 1) * tube_radius * 2
-    layer3_len = (marbles_per_layer - 1) * tube_radius * 2 + tube_radius
+@memoize("window_height_factor")
+def make_windows(layout):
+    """Create window cutouts on the long sides of the box (one Workplane, four separate solids)."""
     
-    layer1_height = layer1_len * slope
-    layer2_height = layer2_len * slope
-    layer3_height = layer3_len * slope
+    tube_radius = layout.tube_radius
+    turn_radius = layout.turn_radius
     
     # Gesamthöhe der Röhre
-    total_height = layer1_height + turn_radius * 2 + layer2_height + turn_radius * 2 + layer3_height
+    total_height = layout.layer3_end_z
     
     # Box-Länge (Y-Richtung)
-    box_start_y = outlet_length
-    box_end_y = outlet_length + layer1_len + turn_radius
+    box_start_y = layout.outlet_end_y
+    box_end_y = layout.turn1_apex_y
     box_length = box_end_y - box_start_y
     
     window_length = box_length * 0.8
@@ -159,65 +404,64 @@ def make_windows():
     # Mitte der Box (Y-Richtung)
     window_center_y = box_start_y + box_length / 2
     
-    # Oberes Fenster - bei 2/3 der Höhe
-    window_upper_z = total_height * 5/10
+    def slot(center_z):
+        """Slot window: box with its Y-parallel edges fully rounded."""
+        box = cq.Solid.makeBox(
+            window_depth, window_length, window_height,
+            pnt=cq.Vector(-window_depth / 2, window_center_y - window_length / 2, center_z - window_height / 2),
+        )
+        return box.fillet(window_height / 2 - 0.1, classify_edges(box)["Y"])
     
-    window_upper = (
-        cq.Workplane("XY")
-        .transformed(offset=(0, window_center_y, window_upper_z))
-        .box(window_depth, window_length, window_height)
-        .edges("|Y").fillet(window_height / 2 - 0.1)
-    )
+    # Oberes Fenster - bei 2/3 der Höhe
+    window_upper = slot(total_height * 5/10)
     
     # Unteres Fenster - auf Höhe von Layer 1
-    window_lower_z = layer1_height / 2
+    window_lower = slot(layout.layer1_height / 2)
     
-    window_lower = (
-        cq.Workplane("XY")
-        .transformed(offset=(0, window_center_y, window_lower_z))
-        .box(window_depth, window_length, window_height)
-        .edges("|Y").fillet(window_height / 2 - 0.1)
-    )
+    # Runde Fenster: Zylinder in +Y-Richtung
+    window_radius = tube_radius * 0.7
+    window_reach = tube_radius * 4
 
     # Rundes Fenster vorne - Höhe der unteren Kurve (Turn 2)
-    turn2_z = layer1_height + turn_radius * 2 + layer2_height + 0.8 * turn_radius
-
-    window_front = (
-        cq.Workplane("XZ")
-        .workplane(offset=outlet_length)  # Y-Position
-        .center(0, turn2_z)
-        .circle(tube_radius * 0.7)
-        .extrude(-tube_radius * 4)
+    turn2_z = layout.layer2_end_z + 0.8 * turn_radius
+
+    window_front = cq.Solid.makeCylinder(
+        window_radius, window_reach,
+        pnt=cq.Vector(0, -layout.outlet_end_y, turn2_z),  # Y-Position
+        dir=cq.Vector(0, 1, 0),
     )
     
     # Rundes Fenster hinten - Höhe der ersten Kurve (Turn 1)
-    turn1_z = layer1_height + turn_radius
-    turn1_y = outlet_length + layer1_len + turn_radius   # Hinter der Kurve
-
-    window_back = (
-        cq.Workplane("XZ")
-        .workplane(offset=-turn1_y)
-        .center(0, turn1_z)
-        .circle(tube_radius * 0.7)
-        .extrude(-tube_radius * 4)  # Nach hinten (+Y) extrudieren
+    turn1_z = layout.turn1_apex_z
+    turn1_y = layout.turn1_apex_y   # Hinter der Kurve
+
+    window_back = cq.Solid.makeCylinder(
+        window_radius, window_reach,
+        pnt=cq.Vector(0, turn1_y, turn1_z),
+        dir=cq.Vector(0, 1, 0),  # Nach hinten (+Y)
     )
     
-    return window_upper.union(window_lower).union(window_front).union(window_back)
+    # Einzelne Solids, kein Compound: jedes Fenster wird eigenes Werkzeug im Cut,
+    # damit OCCT auch Überschneidungen der Fenster untereinander auflöst
+    return cq.Workplane("XY").add([window_upper, window_lower, window_front, window_back])
     
 
 # =============================================================================
 # HOUSING
 # =============================================================================
 
-def make_storage(groove):
-    """Create the housing box with the groove cut out."""
+def make_storage(groove, layout, windows=None):
+    """Create the housing box with the groove (and prebuilt window solids, if given) cut out."""
+    
+    tube_radius = layout.tube_radius
     
-    bb = groove.val().BoundingBox()
+    # Extents known from the layout - walking the swept BRep is expensive
+    bb = groove_bounds(layout)
     
     # Main box (upper part with open channel)
-    box_length = bb.ymax - bb.ymin + 2 * wall_thickness - 2 * tube_radius
-    box_width = bb.xmax - bb.xmin + 2 * wall_thickness + 0.2 * tube_radius
-    box_height = bb.zmax - bb.zmin + wall_thickness - 1.7 * tube_radius
+    box_length = bb.ylen + 2 * wall_thickness - 2 * tube_radius
+    box_width = bb.xlen + 2 * wall_thickness + 0.2 * tube_radius
+    box_height = bb.zlen + wall_thickness - 1.7 * tube_radius
     
     box_center_x = (bb.xmax + bb.xmin) / 2
     box_center_y = (bb.ymax + bb.ymin + 2 * tube_radius) / 2
@@ -230,11 +474,11 @@ def make_storage(groove):
     )
     
     # Ground plate (lower part, fully enclosed tunnel)
-    ground_length = bb.ymax - bb.ymin + 2 * wall_thickness
-    ground_width = bb.xmax - bb.xmin + 2 * wall_thickness + 1 * tube_radius
+    ground_length = bb.ylen + 2 * wall_thickness
+    ground_width = bb.xlen + 2 * wall_thickness + 1 * tube_radius
     ground_height = 1.2 * tube_radius
     
-    ground_center_x = (bb.xmax + bb.xmin) / 2
+    ground_center_x = box_center_x
     ground_center_y = (bb.ymax + bb.ymin) / 2
     ground_center_z = -0.9 * tube_radius
     
@@ -245,38 +489,43 @@ def make_storage(groove):
     )
     
     if enable_fillet:
-        try:
-            ground = ground.edges("|Z").fillet(fillet_radius)
-        except:
-            pass
+        ground_edges = classify_edges(ground.val())
+        box_edges = classify_edges(box.val())
         
-        try:
-            box = box.edges(">Z").fillet(fillet_radius)
-        except:
-            pass
+        ground = fillet_edges(ground, ground_edges["Z"], fillet_radius)
         
-        try:
-            box = box.edges("|Z").fillet(fillet_radius)  # Vertikale Kanten
-        except:
-            pass
+        # Obere und vertikale Kanten der Box in einem Fillet-Aufruf
+        box_top = top_edges(box_edges["X"] + box_edges["Y"])
+        filleted = fillet_edges(box, box_top + box_edges["Z"], fillet_radius)
+        
+        if filleted is box:
+            # Fehlgeschlagen - Gruppen einzeln, damit eine Gruppe nicht die andere mitreißt
+            box = fillet_edges(box, box_top, fillet_radius)
+            box = fillet_edges(box, classify_edges(box.val())["Z"], fillet_radius)
+        else:
+            box = filleted
+    
+    hull = cascade_union([box, ground])
     
-    result = box.union(ground).cut(groove)
+    # Groove and each window as separate tools of one cut - one BOP
+    tools = [groove.val()]
     
     if enable_windows:
-        windows = make_windows()
-        if windows:
-            result = result.cut(windows)
+        if windows is None:
+            windows = make_windows(layout)
+        tools.extend(windows.vals())
     
-    return result
+    return cq.Workplane("XY").add(hull.val().cut(*tools).clean())
 
 # =============================================================================
 # BUILD
 # =============================================================================
 
-path = make_marble_path()
-groove = make_groove_solid(path)
-storage = make_storage(groove)
-windows = make_windows()
+layout = compute_layout(tube_radius, turn_radius, outlet_length, marbles_per_layer, slope)
+path = make_marble_path(layout)
+groove = make_groove_solid(path, layout)
+windows = make_windows(layout) if enable_windows else None
+storage = make_storage(groove, layout, windows=windows)
 
 # Export (uncomment to save)
-# cq.exporters.export(storage, "kullerbue_storage.stl")
\ No newline at end of file
+# cq.exporters.export(storage, "kullerbue_storage.stl", tolerance=stl_tolerance, angularTolerance=stl_angular_tolerance)
\ No newline at end of file